@@ -30,17 +30,35 @@
 #
 # Originally written by Jan Schaumann <jschauma@netmeister.org> in May 2011.
 
+import asyncio
 import getopt
 import http.client
+import io
+import json
+import mmap
+import multiprocessing
 import os
+import random
 import re
+import sqlite3
 import sys
 import time
 import tweepy
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 EXIT_ERROR = 1
 EXIT_SUCCESS = 0
 
+# How often to back off and try again before giving up.
+MAX_RETRIES = 10
+
+PROG = os.path.basename(sys.argv[0])
+DEFAULT_CFG = os.path.expanduser("~/.twistory")
+
 # http://apiwiki.twitter.com/w/page/22554652/HTTP-Response-Codes-and-Errors
 TWITTER_RESPONSE_STATUS = {
         "OK" : 200,
@@ -51,11 +69,14 @@ TWITTER_RESPONSE_STATUS = {
         "NotFound" : 404,
         "NotAcceptable" : 406,
         "SearchRateLimited" : 420,
+        "TooManyRequests" : 429,
         "Broken" : 500,
         "Down" : 502,
         "FailWhale" : 503
     }
 
+TCO_RE = re.compile("https?://t.co/(?P<code>[0-9a-z]+)", re.I)
+
 
 ###
 ### Classes
@@ -71,16 +92,25 @@ class Twistory(object):
         """Construct a Twistory object with default values."""
 
         self.__opts = {
-                    "after"    : -1,
-                    "before"   : -1,
-                    "cfg_file" : os.path.expanduser("~/.twistory"),
-                    "lineify"  : False,
-                    "retweets" : False,
-                    "user"     : ""
+                    "after"       : -1,
+                    "before"      : -1,
+                    "cache_file"  : DEFAULT_CFG + ".cache",
+                    "cfg_file"    : DEFAULT_CFG,
+                    "incremental" : False,
+                    "lineify"     : False,
+                    "retweets"    : False,
+                    "state_file"  : DEFAULT_CFG + ".state",
+                    "user"        : ""
                  }
         self.auth = None
         self.api = None
         self.api_credentials = {}
+        self.api_credentials_list = []
+        self.backoff = 1.0
+        self.retries = 0
+        self.cache = None
+        self.incomplete = False
+        self.tco = None
         self.users = {}
         self.verbosity = 0
 
@@ -90,10 +120,11 @@ class Twistory(object):
 
         def __init__(self, rval):
             self.err = rval
-            self.msg = 'Usage: %s [-hrv] [-[ab] id] -u user\n' % os.path.basename(sys.argv[0])
+            self.msg = 'Usage: %s [-hirv] [-[ab] id] -u user\n' % PROG
             self.msg += '\t-a after   get history since this message\n'
             self.msg += '\t-b before  get history prior to this message\n'
             self.msg += '\t-h         print this message and exit\n'
+            self.msg += '\t-i         only get messages since the last run\n'
             self.msg += '\t-r         print messages that were retweeted\n'
             self.msg += '\t-u user    get history of this user\n'
             self.msg += '\t-v         increase verbosity\n'
@@ -103,75 +134,171 @@ class Twistory(object):
         """Print the requested timeline."""
 
         self.verbose("Fetching tweets...")
+
+        user = self.getOpt("user")
+        state_key = "since_id"
+        if self.getOpt("retweets"):
+            state_key = "retweets_since_id"
+
+        incremental = self.getOpt("incremental") and self.getOpt("before") == -1
+        if incremental:
+            state = self.readState()
+            if self.getOpt("after") == -1:
+                self.setOpt("after", state.get(user, {}).get(state_key, -1))
+
+        newest = None
+        lineify = self.getOpt("lineify")
+        if len(self.api_credentials_list) > 1:
+            pages = self.fetchShards()
+        else:
+            pages = self.fetchRange(self.getOpt("after"), self.getOpt("before"))
+
+        for page in pages:
+            if page and not newest:
+                newest = page[0][0]
+
+            # Unwrap all links of a page in one go.
+            codes = [ m.group('code') for id, msg, created_at in page for m in TCO_RE.finditer(msg) ]
+            links = self.unwrapLinks(codes)
+            unwrap = lambda m: links.get(m.group('code'), m.group(0))
+            lines = []
+            for id, msg, created_at in page:
+                msg = TCO_RE.sub(unwrap, msg)
+                if lineify:
+                    msg = msg.replace("\n", "\\n")
+                lines.append("%s %s (%s)\n" % (id, msg, created_at))
+            sys.stdout.write("".join(lines))
+
+        # If we got everything up to the latest message, the next
+        # incremental run can pick up from there -- but only once all
+        # of it actually made it out of our buffered stdout.
+        if incremental and newest and not self.incomplete:
+            try:
+                sys.stdout.flush()
+            except OSError as e:
+                sys.stderr.write("Unable to write messages, not updating state: %s\n" % e.strerror)
+                return
+            state.setdefault(user, {})[state_key] = newest
+            self.writeState(state)
+
+
+    def fetchRange(self, after, before):
+        """Fetch the requested user's messages between the given ids.
+
+        Arguments:
+            after -- only fetch messages newer than this id (-1 for all)
+            before -- only fetch messages older than this id (-1 for all)
+
+        Returns:
+            A generator yielding one list of (id, message, timestamp)
+            tuples per page of results.
+        """
+
         count = 1
-        lastid = None
+        since_id = None
+        max_id = None
+        if (after > 0):
+            since_id = after
+        if (before > 0):
+            max_id = before - 1
 
-        tco_re = re.compile("https?://t.co/(?P<code>[0-9a-z]+)", re.I)
-        before = self.getOpt("before")
-        after = self.getOpt("after")
         user = self.getOpt("user")
         apicall = self.api.user_timeline
-        loop = True
         if self.getOpt("retweets"):
             apicall = self.api.retweeted_by
-        while loop:
+        pages = tweepy.Cursor(apicall, screen_name=user, count=200,
+                                tweet_mode='extended', since_id=since_id,
+                                max_id=max_id).pages()
+        while True:
             try:
-                pageitems = apicall(screen_name=user, max_id=lastid, count=200)
-                if not pageitems:
-                    break
-                for status in pageitems:
-                    lastid = status.id - 1
-                    self.verbose("Iterating (%d)..." % count, 2)
-                    if (before == -1):
-                        # Ugh. Kludge.  If '-b' was not given, we'd
-                        # like to default to infinity, but that isn't
-                        # working so well, so let's grab the latest
-                        # message of the user in question.  Add one to
-                        # also include that message itself in the
-                        # results.
-                        before = status.id + 1
-
-                    if (status.id < after):
-                        self.verbose("Tweet earlier than threshold, breaking out.", 2)
-                        # Just save us a few pages.  We could of
-                        # course just iterate over all messages, but
-                        # that doesn't do us any good since the API
-                        # does return results sorted already.
-                        loop = False
-                        break
-
-                    count = count + 1
-                    self.verbose("Before: %d; Status: %d; After: %d, lastid: %d" % (before, status.id, after, lastid), 4)
-                    if ((before > status.id) and (status.id > after)):
-                        msg = status.text.encode("UTF-8")
-                        for m in tco_re.finditer(str(msg)):
-                            code = m.group('code')
-                            self.verbose("Unwrapping %s..." % code, 3)
-                            h = http.client.HTTPConnection("t.co")
-                            h.request("GET", "/" + code)
-                            r = h.getresponse()
-                            link = r.getheader("Location")
-                            if link:
-                                tco = re.compile("https?://t.co/" + code)
-                                msg = re.sub(tco, link, str(msg))
-                        if self.getOpt("lineify"):
-                            msg = msg.replace("\n", "\\n")
-                        print("%s %s (%s)" % (status.id, msg, status.created_at))
-            except Exception as e:
-                self.verbose(e)
+                pageitems = next(pages)
+                self.backoff = 1.0
+                self.retries = 0
+            except StopIteration:
+                break
             except http.client.IncompleteRead as e:
                 self.verbose("Incomplete read, trying again in 5 seconds.")
                 time.sleep(5)
+                continue
             except tweepy.error.TweepError as e:
                 if not self.handleTweepError(e, "Unable to get messages for %s" % user):
+                    self.incomplete = True
                     break
-
-            # We reset 'lastid' on each loop; we set it on each item
-            # found. If it's None, then we have no more items to fetch and
-            # should terminate the loop.
-            if not lastid:
+                continue
+            except Exception as e:
+                sys.stderr.write("Unable to get messages for %s: %s\n" % (user, e))
+                self.incomplete = True
                 break
 
+            # Twitter already applied our since_id and max_id, so
+            # everything we get is within the requested range.
+            self.verbose("Iterating (%d)..." % count, 2)
+            count = count + len(pageitems)
+            yield [ (status.id, status.full_text, status.created_at) for status in pageitems ]
+
+
+    def fetchShards(self):
+        """Fetch the requested timeline in parallel.
+
+        The range of message ids is split into one shard per set of api
+        credentials, and each shard is fetched by its own worker process
+        (see fetchShard()), so that each counts against its own rate limit.
+
+        Returns:
+            A generator yielding one list of (id, message, timestamp)
+            tuples per page of results, newest first.
+        """
+
+        user = self.getOpt("user")
+        after = max(self.getOpt("after"), 0)
+        before = self.getOpt("before")
+        open_ended = (before == -1)
+        if open_ended:
+            # We need an upper bound to split, so use the latest message
+            # of the user in question.  Add one to also include that
+            # message itself in the results.
+            apicall = self.api.user_timeline
+            if self.getOpt("retweets"):
+                apicall = self.api.retweeted_by
+            while True:
+                try:
+                    latest = apicall(screen_name=user, count=200)
+                    self.backoff = 1.0
+                    self.retries = 0
+                    break
+                except tweepy.error.TweepError as e:
+                    if not self.handleTweepError(e, "Unable to get messages for %s" % user):
+                        self.incomplete = True
+                        return
+            if not latest:
+                # Twitter drops deleted messages only after applying
+                # 'count', so this doesn't mean there are none; we just
+                # have nothing to split by.
+                self.verbose("No upper bound to split by, fetching without shards.", 2)
+                yield from self.fetchRange(self.getOpt("after"), -1)
+                return
+            before = latest[0].id + 1
+
+        creds = self.api_credentials_list
+        step = max((before - after) // len(creds), 1)
+        bounds = [ max(before - n * step, after + 1) for n in range(len(creds)) ] + [ after + 1 ]
+        jobs = []
+        # Leave the newest shard open if '-b' wasn't given, so that it
+        # also includes anything posted since we looked.
+        if open_ended:
+            bounds[0] = -1
+        for n in range(len(creds)):
+            jobs.append((user, self.getOpt("retweets"), self.verbosity,
+                            creds[n], bounds[n + 1] - 1, bounds[n]))
+
+        self.verbose("Fetching %d shards in parallel..." % len(jobs), 2)
+        with multiprocessing.Pool(processes=len(jobs)) as pool:
+            # imap() hands us the results in order, so we only ever
+            # print from this one process.
+            for pages, incomplete in pool.imap(fetchShard, jobs):
+                self.incomplete = self.incomplete or incomplete
+                yield from pages
+
 
     def getAccessInfo(self, user):
         """Initialize OAuth Access Info (if not found in the configuration file)."""
@@ -205,6 +332,27 @@ class Twistory(object):
 
 
 
+    def getCache(self):
+        """Open the t.co link cache, unless we already did so.
+
+        Returns:
+            An sqlite3 connection, or None if the cache can't be used.
+        """
+
+        if self.cache is None:
+            cfile = self.getOpt("cache_file")
+            try:
+                self.cache = sqlite3.connect(cfile)
+                self.cache.execute("PRAGMA journal_mode=WAL")
+                self.cache.execute("CREATE TABLE IF NOT EXISTS links " +
+                                    "(code TEXT PRIMARY KEY, link TEXT NOT NULL)")
+            except sqlite3.Error as e:
+                self.verbose("Unable to open cache file '%s': %s" % (cfile, e))
+                self.cache = False
+
+        return self.cache or None
+
+
     def getOpt(self, opt):
         """Retrieve the given configuration option.
 
@@ -212,55 +360,48 @@ class Twistory(object):
             The value for the given option if it exists, None otherwise.
         """
 
-        try:
-            r = self.__opts[opt]
-        except ValueError:
-            r = None
-
-        return r
+        return self.__opts.get(opt)
 
     def handleTweepError(self, tweeperr, info):
-        """Try to handle a Tweepy Error by bitching about it."""
+        """Try to handle a Tweepy Error by bitching about it.
+
+        If we were rate limited, we sleep for as long as Twitter tells us
+        to; if Twitter is having a bad day, we back off exponentially.
+
+        Returns:
+            True if the caller should try again, False otherwise.
+        """
 
         diff = 0
         errmsg = ""
+        now = time.asctime()
 
-        try:
-            rate_limit = self.api.rate_limit_status()
-        except tweepy.error.TweepError as e:
-            # Hey now, look at that, we can failwahle on getting the api
-            # status. Neat, huh? Let's pretend that didn't happen and move
-            # on, why not.
-            return
-
-        if hasattr(tweeperr, 'response'):
+        if hasattr(tweeperr, 'response') and tweeperr.response is not None:
             response = tweeperr.response
-            if hasattr(response, 'status'):
-                status = response.status
-                if status == TWITTER_RESPONSE_STATUS["FailWhale"]:
-                    errmsg = "Twitter #FailWhale'd on me on %s." % time.asctime()
-                elif status == TWITTER_RESPONSE_STATUS["Broken"]:
-                    errmsg = "Twitter is busted again: %s" % time.asctime()
-                elif status == TWITTER_RESPONSE_STATUS["RateLimited"] or \
-                    tweeperr.response.status == TWITTER_RESPONSE_STATUS["SearchRateLimited"]:
-                    errmsg = "Rate limited until %s." % rate_limit["reset_time"]
-                    diff = rate_limit["reset_time_in_seconds"] - time.time()
-                    if rate_limit["remaining_hits"] > 0:
-                        # False alarm?  We occasionally seem to hit a race
-                        # condition where one call falls directly onto the
-                        # reset time, so we appear to be throttled for 59:59
-                        # minutes, but actually aren't.  Let's pretend that
-                        # didn't happen.
-                        return
-                else:
-                    errmsg = "On %s Twitter told me:\n'%s'" % (time.asctime(), tweeperr)
+            status = getattr(response, 'status_code', getattr(response, 'status', None))
+            headers = getattr(response, 'headers', None) or {}
+            retry_after = headers.get("Retry-After")
+            reset = headers.get("X-Rate-Limit-Reset") or headers.get("X-RateLimit-Reset")
+            try:
+                if retry_after:
+                    diff = max(float(retry_after), 0) + random.uniform(0, 0.5)
+                elif reset and status in (TWITTER_RESPONSE_STATUS["SearchRateLimited"],
+                                          TWITTER_RESPONSE_STATUS["TooManyRequests"]):
+                    diff = max(float(reset) - time.time(), 0) + random.uniform(0, 0.5)
+            except ValueError:
+                diff = 0
+
+            if diff:
+                errmsg = "Rate limited until %s." % time.asctime(time.localtime(time.time() + diff))
+            else:
+                handler = STATUS_HANDLERS.get(status, handleOtherError)
+                errmsg, diff = handler(self, tweeperr, now)
         else:
             errmsg = tweeperr.reason
 
         sys.stderr.write(info + "\n" + errmsg + "\n")
 
         if diff:
-            diff = diff + 2
             sys.stderr.write("Sleeping for %d seconds...\n" % diff)
             time.sleep(diff)
             return True
@@ -268,6 +409,63 @@ class Twistory(object):
         return False
 
 
+    def backOff(self):
+        """Return the number of seconds to wait before trying again, and
+        double the time to wait after that.  Returns 0 once we've tried
+        MAX_RETRIES times in a row, at which point we give up."""
+
+        if self.retries >= MAX_RETRIES:
+            sys.stderr.write("Giving up after %d retries.\n" % self.retries)
+            self.incomplete = True
+            return 0
+
+        self.retries = self.retries + 1
+        diff = min(self.backoff, 300) + random.uniform(0, 1)
+        self.backoff = self.backoff * 2
+        return diff
+
+
+    def lookupCode(self, code):
+        """Resolve a single t.co code over our connection to t.co, which
+        we keep open across lookups; returns None if we can't."""
+
+        self.verbose("Unwrapping %s..." % code, 3)
+        for attempt in range(2):
+            if not self.tco:
+                self.tco = http.client.HTTPSConnection("t.co", timeout=5)
+            try:
+                self.tco.request("HEAD", "/" + code)
+                r = self.tco.getresponse()
+                r.read()
+                return r.getheader("Location")
+            except (http.client.HTTPException, OSError) as e:
+                # t.co may have closed the connection on us, so try
+                # again with a new one.
+                self.tco.close()
+                self.tco = None
+                err = e
+
+        self.verbose("Unable to unwrap %s: %s" % (code, err), 2)
+        return None
+
+
+    def makeApi(self, creds):
+        """Create an api object from the given api credentials.
+
+        If the credentials include a user's access token, we authenticate
+        as that user; otherwise we use application-only authentication,
+        which is sufficient to read public timelines.
+        """
+
+        if "access_key" in creds:
+            auth = tweepy.OAuthHandler(creds["key"], creds["secret"])
+            auth.set_access_token(creds["access_key"], creds["access_secret"])
+        else:
+            auth = tweepy.AppAuthHandler(creds["key"], creds["secret"])
+
+        return tweepy.API(auth)
+
+
     def parseConfig(self, cfile):
         """Parse the configuration file and set appropriate variables.
 
@@ -282,42 +480,39 @@ class Twistory(object):
         """
 
         try:
-            f = open(cfile, "r")
+            f = open(cfile, "rb")
         except IOError as e:
             sys.stderr.write("Unable to open config file '%s': %s\n" % \
                 (cfile, e.strerror))
             sys.exit(self.EXIT_ERROR)
 
-        key_pattern = re.compile('^(?P<username>[^#]+)_key\s*=\s*(?P<key>.+)')
-        secret_pattern = re.compile('^(?P<username>[^#]+)_secret\s*=\s*(?P<secret>.+)')
-        for line in f.readlines():
-            line = line.strip()
-            key_match = key_pattern.match(line)
-            if key_match:
-                user = key_match.group('username')
-                if user == "<api>":
-                    self.api_credentials['key'] = key_match.group('key')
-                else:
-                    if user in self.users:
-                        self.users[user]['key'] = key_match.group('key')
-                    else:
-                        self.users[user] = {
-                            "key" : key_match.group('key')
-                        }
-
-            secret_match = secret_pattern.match(line)
-            if secret_match:
-                user = secret_match.group('username')
-                if user == "<api>":
-                    self.api_credentials['secret'] = secret_match.group('secret')
-                else:
-                    if user in self.users:
-                        self.users[user]['secret'] = secret_match.group('secret')
-                    else:
-                        self.users[user] = {
-                            "secret" : secret_match.group('secret')
-                        }
-        f.close()
+        entries = []
+        entry_pattern = re.compile(rb'^[ \t]*(?P<username>[^#\r\n]+)_(?P<kind>key|secret)[ \t]*=[ \t]*(?P<value>[^\s][^\r\n]*)', re.M)
+        with f:
+            # An empty file can't be mapped, but then there's nothing
+            # to parse, either.
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    entries = [ m.group('username', 'kind', 'value') for m in entry_pattern.finditer(mm) ]
+
+        extra_credentials = {}
+        api_pattern = re.compile('^<api>_(?P<n>[0-9]+)$')
+        for entry in entries:
+            user, kind, value = [ e.decode("UTF-8").strip() for e in entry ]
+            api_match = api_pattern.match(user)
+            if user == "<api>":
+                self.api_credentials[kind] = value
+            elif api_match:
+                n = int(api_match.group('n'))
+                extra_credentials.setdefault(n, {})[kind] = value
+            else:
+                self.users.setdefault(user, {})[kind] = value
+
+        self.api_credentials_list = [ self.api_credentials ]
+        for n in sorted(extra_credentials):
+            creds = extra_credentials[n]
+            if "key" in creds and "secret" in creds:
+                self.api_credentials_list.append(creds)
 
 
     def parseOptions(self, inargs):
@@ -331,7 +526,7 @@ class Twistory(object):
         """
 
         try:
-            opts, args = getopt.getopt(inargs, "a:b:hlru:v")
+            opts, args = getopt.getopt(inargs, "a:b:hilru:v")
         except getopt.GetoptError:
             raise self.Usage(EXIT_ERROR)
 
@@ -343,6 +538,8 @@ class Twistory(object):
                     self.setOpt("before", int(a))
                 if o in ("-h"):
                     raise self.Usage(EXIT_SUCCESS)
+                if o in ("-i"):
+                    self.setOpt("incremental", True)
                 if o in ("-l"):
                     self.setOpt("lineify", True)
                 if o in ("-r"):
@@ -359,6 +556,29 @@ class Twistory(object):
             raise self.Usage(EXIT_ERROR)
 
 
+    def readState(self):
+        """Read the state left behind by previous runs.
+
+        Returns:
+            A dictionary of per-user state; empty if there is none.
+        """
+
+        sfile = self.getOpt("state_file")
+        try:
+            with open(sfile, "r") as f:
+                state = json.load(f)
+            if not isinstance(state, dict) or \
+                not all(isinstance(ids, dict) for ids in state.values()) or \
+                not all(type(id) is int for ids in state.values() for id in ids.values()):
+                raise ValueError("not a dictionary of message ids per user")
+            return state
+        except FileNotFoundError:
+            return {}
+        except (IOError, ValueError) as e:
+            sys.stderr.write("Unable to read state file '%s': %s\n" % (sfile, e))
+            return {}
+
+
     def setOpt(self, opt, val):
         """Set the given option to the provided value."""
 
@@ -374,6 +594,98 @@ class Twistory(object):
 
         self.api = tweepy.API(self.auth)
 
+        # Worker processes can't share our api object, so let them know
+        # how to create their own.
+        self.api_credentials['access_key'] = key
+        self.api_credentials['access_secret'] = secret
+
+
+    def unwrapLinks(self, codes):
+        """Resolve the given t.co codes into the links they point to.
+
+        If aiohttp is available, all codes are looked up concurrently;
+        otherwise we ask t.co about each one in turn over a single
+        connection.
+
+        Arguments:
+            codes -- a list of t.co codes
+
+        Returns:
+            A dictionary mapping each code to its link; codes that could
+            not be resolved are omitted.
+        """
+
+        codes = list(dict.fromkeys(codes))
+        links = {}
+
+        # t.co links never change, so there's no need to ask about any
+        # we've seen before.
+        cache = self.getCache()
+        if cache:
+            for code in codes:
+                row = cache.execute("SELECT link FROM links WHERE code = ?", (code,)).fetchone()
+                if row:
+                    links[code] = row[0]
+            codes = [ code for code in codes if code not in links ]
+
+        if not codes:
+            return links
+
+        if aiohttp:
+            found = asyncio.run(self.unwrapPage(codes))
+        else:
+            found = {}
+            for code in codes:
+                link = self.lookupCode(code)
+                if link:
+                    found[code] = link
+
+        if cache and found:
+            try:
+                with cache:
+                    cache.executemany("INSERT OR IGNORE INTO links VALUES (?, ?)", found.items())
+            except sqlite3.Error as e:
+                self.verbose("Unable to update cache: %s" % e)
+
+        links.update(found)
+        return links
+
+
+    async def unwrapPage(self, codes):
+        """Concurrently resolve the given t.co codes over a single session."""
+
+        connector = aiohttp.TCPConnector(limit_per_host=64)
+        timeout = aiohttp.ClientTimeout(total=5)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            tasks = [ self.unwrapCode(session, code) for code in codes ]
+            links = await asyncio.gather(*tasks)
+
+        return { code : link for code, link in zip(codes, links) if link }
+
+
+    async def unwrapCode(self, session, code):
+        """Resolve a single t.co code; returns None if we can't."""
+
+        self.verbose("Unwrapping %s..." % code, 3)
+        try:
+            async with session.head("https://t.co/%s" % code, allow_redirects=False) as r:
+                return r.headers.get("Location")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.verbose("Unable to unwrap %s: %s" % (code, e), 2)
+            return None
+
+
+    def writeState(self, state):
+        """Save the given state for the next run."""
+
+        sfile = self.getOpt("state_file")
+        try:
+            with open(sfile + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(sfile + ".tmp", sfile)
+        except IOError as e:
+            sys.stderr.write("Unable to write state file '%s': %s\n" % (sfile, e.strerror))
+
 
     def verbose(self, msg, level=1):
         """Print given message to STDERR if the object's verbosity is >=
@@ -392,11 +704,89 @@ class Twistory(object):
 
 
 
+###
+### Functions
+###
+
+def fetchShard(job):
+    """Fetch one shard of a timeline in a worker process.
+
+    Arguments:
+        job -- a tuple of (user, retweets, verbosity, credentials, after,
+               before) as set up by Twistory.fetchShards()
+
+    Returns:
+        A list of pages as yielded by Twistory.fetchRange(), and whether
+        we had to give up before fetching all of them.
+    """
+
+    user, retweets, verbosity, creds, after, before = job
+
+    worker = Twistory()
+    worker.setOpt("user", user)
+    worker.setOpt("retweets", retweets)
+    worker.verbosity = verbosity
+    try:
+        # Application-only auth fetches its token right away, so bad
+        # credentials show up here.
+        worker.api = worker.makeApi(creds)
+    except tweepy.error.TweepError as e:
+        sys.stderr.write("Unable to set up api for %s: %s\n" % (user, e))
+        return [], True
+
+    pages = list(worker.fetchRange(after, before))
+    return pages, worker.incomplete
+
+
+def handleFailWhale(twistory, tweeperr, now):
+    """Handle a 503 from Twitter; returns an error message and how long
+    to wait before trying again, as do all of the error handlers."""
+
+    return "Twitter #FailWhale'd on me on %s." % now, twistory.backOff()
+
+
+def handleBroken(twistory, tweeperr, now):
+    """Handle a 500 from Twitter."""
+
+    return "Twitter is busted again: %s" % now, twistory.backOff()
+
+
+def handleDown(twistory, tweeperr, now):
+    """Handle a 502 from Twitter."""
+
+    return "Twitter is down: %s" % now, twistory.backOff()
+
+
+def handleRateLimited(twistory, tweeperr, now):
+    """Handle being rate limited without being told for how long."""
+
+    return "Rate limited on %s." % now, twistory.backOff()
+
+
+def handleOtherError(twistory, tweeperr, now):
+    """Handle any other error; these we don't retry."""
+
+    return "On %s Twitter told me:\n'%s'" % (now, tweeperr), 0
+
+
+STATUS_HANDLERS = {
+        TWITTER_RESPONSE_STATUS["SearchRateLimited"] : handleRateLimited,
+        TWITTER_RESPONSE_STATUS["TooManyRequests"] : handleRateLimited,
+        TWITTER_RESPONSE_STATUS["Broken"] : handleBroken,
+        TWITTER_RESPONSE_STATUS["Down"] : handleDown,
+        TWITTER_RESPONSE_STATUS["FailWhale"] : handleFailWhale
+    }
+
+
 ###
 ### "Main"
 ###
 
 if __name__ == "__main__":
+    # We may print a lot of messages; there's no need to flush after
+    # each one.
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="UTF-8",
+                                    line_buffering=False, write_through=False)
     try:
         twistory = Twistory()
         try: